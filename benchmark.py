@@ -1,11 +1,14 @@
-import sys
+import argparse
+import shutil
 import tempfile
+import time
 import timeit
 import os
 import collections
 from pprint import pprint
 
 FILE_SIZES_MB = tuple(2 ** x for x in range(12))
+SMALL_FILE_SIZES_B = (512, 4 * 1024, 32 * 1024)
 
 
 def generate_file(parent_dir, size_b):
@@ -17,12 +20,124 @@ def generate_file(parent_dir, size_b):
     return filepath
 
 
+def benchmark_small_files(parent_dir, count):
+    """ Measure files/s when copying many small files. """
+    import speedcopy
+
+    data = collections.OrderedDict()
+    for size_b in SMALL_FILE_SIZES_B:
+        print("--- Testing {} files of {} b".format(count, size_b))
+        src_dir = tempfile.mkdtemp(dir=parent_dir)
+        sources = []
+        for i in range(count):
+            src = os.path.join(src_dir, "{:06d}.src".format(i))
+            with open(src, 'wb') as f:
+                f.write(os.urandom(size_b))
+            sources.append(src)
+        datapoint = []
+        for copy_func in (shutil.copyfile, speedcopy.copyfile):
+            start = time.time()
+            for src in sources:
+                copy_func(src, src + ".dst")
+            rate = count / (time.time() - start)
+            print(">>> {}.{}: {} files/s".format(
+                copy_func.__module__, copy_func.__name__, round(rate)))
+            datapoint.append(rate)
+            for src in sources:
+                os.remove(src + ".dst")
+        shutil.rmtree(src_dir)
+        data[size_b] = tuple(datapoint)
+    return data
+
+
+def benchmark_dedupe(parent_dir, ratio, count=200, size_b=1024 * 1024):
+    """ Copy synthetic dataset with given ratio of duplicate files. """
+    import speedcopy
+
+    src_dir = tempfile.mkdtemp(dir=parent_dir)
+    unique = max(1, int(round(count * (1 - ratio))))
+    contents = [os.urandom(size_b) for _ in range(unique)]
+    pairs = []
+    for i in range(count):
+        src = os.path.join(src_dir, "{:06d}.src".format(i))
+        with open(src, 'wb') as f:
+            f.write(contents[i % unique])
+        pairs.append((src, src + ".dst"))
+    print("--- {} files of {} b, {} unique".format(count, size_b, unique))
+
+    data = collections.OrderedDict()
+    for dedupe in (None, "reflink", "hardlink"):
+        start = time.time()
+        result = speedcopy.copyfiles(pairs, dedupe=dedupe)
+        elapsed = time.time() - start
+        print(">>> dedupe={}: {} s, {} files/s, {} b avoided".format(
+            dedupe, round(elapsed, 4), round(count / elapsed),
+            result.bytes_deduplicated))
+        data[dedupe] = (elapsed, result.bytes_deduplicated)
+        for _, dst in pairs:
+            os.remove(dst)
+    shutil.rmtree(src_dir)
+    return data
+
+
+def benchmark_import_time(count):
+    """ Measure import time of speedcopy using -X importtime. """
+    import subprocess
+    import sys
+
+    cumulative = []
+    for _ in range(count):
+        proc = subprocess.Popen(
+            [sys.executable, "-X", "importtime", "-c", "import speedcopy"],
+            stderr=subprocess.PIPE, universal_newlines=True)
+        _, stderr = proc.communicate()
+        for line in stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == "speedcopy":
+                cumulative.append(int(fields[1]))
+    cumulative.sort()
+    data = collections.OrderedDict([
+        ("min_us", cumulative[0]),
+        ("median_us", cumulative[len(cumulative) // 2]),
+        ("max_us", cumulative[-1])])
+    print(">>> import speedcopy: {} us (median of {})".format(
+        data["median_us"], count))
+    return data
+
+
 if __name__ == "__main__":
-    try:
-        dir = sys.argv[1]
-    except (KeyError, IndexError):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dir", nargs="?", default=None,
+                        help="directory where to put test files")
+    parser.add_argument("--small-files", type=int, default=0, metavar="N",
+                        help="measure files/s copying N small files instead")
+    parser.add_argument("--dedupe", type=float, default=None,
+                        metavar="RATIO",
+                        help=("measure deduplicating batch copy of dataset "
+                              "with RATIO (0-1) of duplicate files instead"))
+    parser.add_argument("--import-time", type=int, default=0, metavar="N",
+                        help="measure import time N times instead")
+    args = parser.parse_args()
+
+    if args.import_time:
+        pprint(benchmark_import_time(args.import_time))
+        raise SystemExit(0)
+
+    dir = args.dir
+    if dir is None:
         print("pass destination directory as an argument if you want")
-        dir = None
+
+    if args.small_files:
+        with tempfile.TemporaryDirectory(dir=dir) as tmp_dir:
+            print("--- using dir {}".format(tmp_dir))
+            pprint(benchmark_small_files(tmp_dir, args.small_files))
+        raise SystemExit(0)
+
+    if args.dedupe is not None:
+        with tempfile.TemporaryDirectory(dir=dir) as tmp_dir:
+            print("--- using dir {}".format(tmp_dir))
+            pprint(benchmark_dedupe(tmp_dir, args.dedupe))
+        raise SystemExit(0)
 
     with tempfile.TemporaryDirectory(dir=dir) as tmp_dir:
         print("--- using dir {}".format(tmp_dir))
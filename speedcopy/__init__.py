@@ -11,6 +11,8 @@ See:
 
 Attributes:
     SPEEDCOPY_DEBUG (bool): set to print debug messages.
+    SMALL_FILE_THRESHOLD (int): files up to this size are copied using
+        small-file fast path (not on Windows).
 
 """
 import errno
@@ -18,7 +20,8 @@ import os
 import shutil
 import stat
 import sys
-import ctypes
+
+from . import throttle
 
 SPEEDCOPY_DEBUG = False
 
@@ -40,9 +43,6 @@ if not sys.platform.startswith("win32"):
         else:
             _sendfile = sendfile.sendfile
     from fcntl import ioctl
-    import ctypes.util
-    from ctypes import c_int
-    from .fstatfs import FilesystemInfo
 
     CIFS_MAGIC_NUMBER = 0xFF534D42
     SMB2_MAGIC_NUMBER = 0xFE534D42
@@ -73,6 +73,7 @@ if not sys.platform.startswith("win32"):
         ioctl command number.
 
         """
+        import ctypes
         result = ctypes.sizeof(t)
         assert result <= _IOC_SIZEMASK, result
         return result
@@ -102,17 +103,220 @@ if not sys.platform.startswith("win32"):
         """
         return IOC(IOC_WRITE, type, nr, IOC_TYPECHECK(size))
 
+    # files up to this size (in bytes) are copied by the small-file fast
+    # path using single read and write
+    SMALL_FILE_THRESHOLD = 64 * 1024
+
+    # maximum bytes copied by one sendfile call and buffered read, rate
+    # limits are checked between them
+    _SENDFILE_CHUNK_SIZE = 64 * 1024 * 1024
+    _BUFFER_SIZE = 1024 * 1024
+
+    # filesystems supporting server-side copy
+    _SERVER_SIDE_COPY_FS = ('CIFS', 'SMB2')
+
+    # O_NONBLOCK prevents blocking on named pipes, it has no effect
+    # on regular files
+    _O_SMALL_READ = os.O_RDONLY | os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0)
+    _O_SMALL_WRITE = (os.O_WRONLY | os.O_CREAT | os.O_NONBLOCK
+                      | getattr(os, 'O_CLOEXEC', 0))
+
+    # server-side copy ioctl is linux only
+    _IS_LINUX = sys.platform.startswith("linux")
+
+    # created on first use, loading libc via ctypes is not for free
+    _fs_info = None
+    # filesystem type cached per device (st_dev)
+    _fs_type_cache = {}
+
+    def _filesystem_info():
+        """Get shared :class:`speedcopy.fstatfs.FilesystemInfo` instance."""
+        global _fs_info
+        if _fs_info is None:
+            from .fstatfs import FilesystemInfo
+            _fs_info = FilesystemInfo()
+        return _fs_info
+
+    def _filesystem_type(path_or_fd, st):
+        """Get filesystem type of file.
+
+        Result is cached by device id so ``statfs`` is called only once
+        per mounted filesystem. Filesystems on block devices (non-zero
+        major device number) can't be network shares and are not examined
+        at all - ctypes is not even loaded for them.
+
+        Args:
+            path_or_fd (bytes or int): Path or file descriptor.
+            st (os.stat_result): Result of ``os.stat()`` on it.
+
+        Returns:
+            str: Filesystem type name or None if it can't be network share.
+
+        """
+        try:
+            return _fs_type_cache[st.st_dev]
+        except KeyError:
+            fs_type = None
+            if _IS_LINUX and not os.major(st.st_dev):
+                fs_type = _filesystem_info().filesystem(path_or_fd)
+            _fs_type_cache[st.st_dev] = fs_type
+            return fs_type
+
+    def _copyfile_small(src, dst):
+        """Copy small regular file with minimal number of system calls.
+
+        Each file descriptor is examined by single ``fstat``, data are
+        read by single ``read`` and written by single ``write``. Neither
+        ``sendfile`` nor ``statfs`` on paths is used - filesystem type
+        is taken from cache.
+
+        One byte more than ``st_size`` is requested so files larger than
+        reported (grown after ``fstat``, procfs/sysfs files reporting zero
+        size) are detected and left to regular copy.
+
+        Args:
+            src (str): Source file.
+            dst (str): Destination file.
+
+        Returns:
+            bool: True on success, False if file is not eligible and
+                regular copy should be used instead.
+
+        Raises:
+            shutil.SpecialFileError: when destination is a named pipe.
+            shutil.SameFileError: if ``src`` and ``dst`` are same.
+
+        """
+        try:
+            fsrc = os.open(src, _O_SMALL_READ)
+        except OSError:
+            return False
+        try:
+            st_src = os.fstat(fsrc)
+            if not stat.S_ISREG(st_src.st_mode) or \
+                    st_src.st_size > SMALL_FILE_THRESHOLD:
+                return False
+            try:
+                fdst = os.open(dst, _O_SMALL_WRITE, 0o666)
+            except OSError:
+                # named pipe without reader, permissions, ... let regular
+                # copy deal with it
+                return False
+            try:
+                st_dst = os.fstat(fdst)
+                if st_src.st_dev == st_dst.st_dev and \
+                        st_src.st_ino == st_dst.st_ino:
+                    raise shutil.SameFileError(
+                        "{!r} and {!r} are the same file".format(src, dst))
+                if stat.S_ISFIFO(st_dst.st_mode):
+                    raise shutil.SpecialFileError(
+                        "`%s` is a named pipe" % dst)
+                if not stat.S_ISREG(st_dst.st_mode):
+                    return False
+                if _filesystem_type(fsrc, st_src) in _SERVER_SIDE_COPY_FS \
+                        and _filesystem_type(fdst, st_dst) in _SERVER_SIDE_COPY_FS:  # noqa: E501
+                    # server-side copy is preferred
+                    return False
+                expected = st_src.st_size
+                chunks = []
+                size = 0
+                while size < expected or not chunks:
+                    buf = os.read(fsrc, expected + 1 - size)
+                    if not buf:
+                        # EOF, file may have shrunk
+                        break
+                    chunks.append(buf)
+                    size += len(buf)
+                if size > expected:
+                    debug(">>> {} is larger than reported".format(src))
+                    return False
+                if throttle.active():
+                    # single write, no need to follow later changes
+                    limit = throttle.limiter(st_dst.st_dev)
+                    limit.file()
+                    limit.transfer(size)
+                data = memoryview(b"".join(chunks))
+                while data:
+                    data = data[os.write(fdst, data):]
+                if st_dst.st_size > size:
+                    # destination existed and was larger
+                    os.ftruncate(fdst, size)
+            finally:
+                os.close(fdst)
+        finally:
+            os.close(fsrc)
+        debug(">>> small file copied")
+        return True
+
     # errnos sendfile can set if not supported on the system
     _sendfile_err_codes = {code for code, name in errno.errorcode.items()
                            if name in ("EINVAL", "ENOSYS", "ENOTSUP",
                                        "EBADF", "ENOTSOCK", "EOPNOTSUPP")}
 
-    def _copyfile_sendfile(fsrc, fdst):
+    # errnos FICLONE can set if reflinks are not possible
+    _reflink_err_codes = {code for code, name in errno.errorcode.items()
+                          if name in ("EINVAL", "ENOSYS", "ENOTSUP", "ENOTTY",
+                                      "EOPNOTSUPP", "EXDEV", "EBADF")}
+
+    def _reflink(src, dst):
+        """Create ``dst`` as reflink (copy-on-write clone) of ``src``.
+
+        Args:
+            src (str): Source file.
+            dst (str): Destination file.
+
+        Returns:
+            bool: True on success, False if filesystem doesn't support
+                reflinks or files are on different filesystems.
+
+        """
+        from ctypes import c_int
+
+        # FICLONE from linux/fs.h
+        FICLONE = IOW(0x94, 9, c_int)
+        fsrc = os.open(src, os.O_RDONLY)
+        try:
+            fdst = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            try:
+                ioctl(fdst, FICLONE, fsrc)
+            except (IOError, OSError) as e:
+                if e.errno in _reflink_err_codes:
+                    debug("!!! reflink not supported: {}".format(e.errno))
+                    return False
+                raise
+            finally:
+                os.close(fdst)
+        finally:
+            os.close(fsrc)
+        return True
+
+    def _copyfileobj(fsrc, fdst, limit):
+        """Copy data from fsrc to fdst using buffered read and write.
+
+        Args:
+            fsrc (file): Source file.
+            fdst (file): Destination file.
+            limit (speedcopy.throttle.Limiter): Rate limit.
+
+        """
+        while True:
+            buf = fsrc.read(limit.chunk_size(_BUFFER_SIZE))
+            if not buf:
+                break
+            limit.transfer(len(buf))
+            fdst.write(buf)
+
+    def _copyfile_sendfile(fsrc, fdst, limit):
         """Copy data from fsrc to fdst using sendfile.
 
+        Data are sent in chunks of ``_SENDFILE_CHUNK_SIZE`` (or
+        ``throttle.CHUNK_SIZE`` if throttled), so limits set during the
+        copy are applied.
+
         Args:
             fsrc (str): Source file.
             fdst (str): Destination file.
+            limit (speedcopy.throttle.Limiter): Rate limit.
 
         Returns:
             bool: True on success.
@@ -121,17 +325,18 @@ if not sys.platform.startswith("win32"):
         if not _sendfile:
             return False
         status = False
-        max_bcount = 2 ** 31 - 1
-        bcount = max_bcount
+        bcount = 1
         offset = 0
         fdstno = fdst.fileno()
         fsrcno = fsrc.fileno()
 
         try:
             while bcount > 0:
-                bcount = _sendfile(fdstno, fsrcno, offset, max_bcount)
+                bcount = _sendfile(fdstno, fsrcno, offset,
+                                   limit.chunk_size(_SENDFILE_CHUNK_SIZE))
                 offset += bcount
                 status = True
+                limit.transfer(bcount)
         except OSError as e:
             if e.errno in _sendfile_err_codes:
                 # sendfile is not supported or does not support classic
@@ -161,6 +366,9 @@ if not sys.platform.startswith("win32"):
             shutil.SameFileError: if ``src`` and ``dst`` are same.
 
         """
+        if follow_symlinks and _copyfile_small(src, dst):
+            return dst
+
         if shutil._samefile(src, dst):
             raise shutil.SameFileError(
                 "{!r} and {!r} are the same file".format(src, dst))
@@ -180,19 +388,29 @@ if not sys.platform.startswith("win32"):
             debug(">>> creating symlink ...")
             os.symlink(os.readlink(src), dst)
         else:
-            fs_src_type = FilesystemInfo().filesystem(src.encode('utf-8'))
+            fs_src_type = _filesystem_type(src.encode('utf-8'), os.stat(src))
             dst_dir_path = os.path.normpath(os.path.dirname(dst.encode('utf-8')))  # noqa: E501
-            fs_dst_type = FilesystemInfo().filesystem(dst_dir_path)
-            supported_fs = ['CIFS', 'SMB2']
+            dst_dir_st = os.stat(dst_dir_path)
+            fs_dst_type = _filesystem_type(dst_dir_path, dst_dir_st)
+            limit = throttle.limiter(dst_dir_st.st_dev)
+            limit.file()
             debug(">>> Source FS: {}".format(fs_src_type))
             debug(">>> Destination FS: {}".format(fs_dst_type))
-            if fs_src_type in supported_fs and fs_dst_type in supported_fs:
+            if fs_src_type in _SERVER_SIDE_COPY_FS and \
+                    fs_dst_type in _SERVER_SIDE_COPY_FS:
                 fsrc = os.open(src, os.O_RDONLY)
                 fdst = os.open(dst, os.O_WRONLY | os.O_CREAT)
 
+                from ctypes import c_int
+
                 CIFS_IOCTL_MAGIC = 0xCF
                 CIFS_IOC_COPYCHUNK_FILE = IOW(CIFS_IOCTL_MAGIC, 3, c_int)
 
+                if limit.throttled():
+                    # whole file is copied by single call, account it
+                    # beforehand
+                    limit.transfer(os.fstat(fsrc).st_size)
+
                 # try copy file with COW support on Linux. If fail, fallback
                 # to sendfile and if this is not available too, fallback
                 # copyfileobj.
@@ -205,77 +423,97 @@ if not sys.platform.startswith("win32"):
                     os.close(fdst)
                     # Try to use sendfile if available for performance
                     with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
-                        if not _copyfile_sendfile(fsrc, fdst):
+                        if not _copyfile_sendfile(fsrc, fdst, limit):
                             debug("!!! failed sendfile")
                             # sendfile is not available or failed, fallback
                             # to copyfileobj
-                            shutil.copyfileobj(fsrc, fdst)
+                            _copyfileobj(fsrc, fdst, limit)
             else:
                 with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
-                    if not _copyfile_sendfile(fsrc, fdst):
+                    if not _copyfile_sendfile(fsrc, fdst, limit):
                         # sendfile is not available or failed, fallback
                         # to copyfileobj
-                        shutil.copyfileobj(fsrc, fdst)
+                        _copyfileobj(fsrc, fdst, limit)
 
         return dst
 
 else:
     # Windows
-    # Initialize once on import for performance
-    kernel32 = ctypes.WinDLL('kernel32',
-                             use_last_error=True,
-                             use_errno=True)
-    try:
-        COPYFILE = kernel32.CopyFile2
-        is_copyfile2 = True
-    except AttributeError:
-        # on windows 7 and older
-        COPYFILE = kernel32.CopyFileW
-        is_copyfile2 = False
-
-    COPYFILE.restype = ctypes.HRESULT
-
-    if is_copyfile2:
-        # Skip alternate streams in CopyFile2
-        from ctypes import wintypes
-
-        class COPYFILE2_EXTENDED_PARAMETERS(ctypes.Structure):
-            """
-            typedef struct COPYFILE2_EXTENDED_PARAMETERS {
-              DWORD                       dwSize;
-              DWORD                       dwCopyFlags;
-              BOOL                        *pfCancel;
-              PCOPYFILE2_PROGRESS_ROUTINE pProgressRoutine;
-              PVOID                       pvCallbackContext;
-            } COPYFILE2_EXTENDED_PARAMETERS;
-            """
-
-            _fields_ = [
-                ("dwSize", wintypes.DWORD),
-                ("dwCopyFlags", wintypes.DWORD),
-                # The rest isn't actually void, but by making these
-                # voids the call speed is much faster - especially with
-                # pProgressRoutine as void instead of WINFUNCTYPE
-                ("pfCancel", ctypes.c_void_p),
-                ("pProgressRoutine", ctypes.c_void_p),
-                ("pvCallbackContext", ctypes.c_void_p)
-            ]
-
-        PARAMS = COPYFILE2_EXTENDED_PARAMETERS()
-        PARAMS.dwSize = ctypes.sizeof(COPYFILE2_EXTENDED_PARAMETERS)
-        PARAMS.dwCopyFlags = 0x00008000  # COPY_FILE_SKIP_ALTERNATE_STREAMS
-        COPYFILE.argtypes = (
-            ctypes.c_wchar_p,
-            ctypes.c_wchar_p,
-            ctypes.POINTER(COPYFILE2_EXTENDED_PARAMETERS)
-        )
-
-    else:
-        COPYFILE.argtypes = (ctypes.c_wchar_p,
-                             ctypes.c_wchar_p,
-                             ctypes.c_void_p)
-        PARAMS = None
+    # Initialized once on first copy, see _init_copyfile()
+    kernel32 = None
+    is_copyfile2 = None
+    COPYFILE = None
+    PARAMS = None
+
+    def _init_copyfile():
+        """Bind ``CopyFile2`` (or ``CopyFileW``) from kernel32.
+
+        Returns:
+            function: Bound ``COPYFILE`` function.
+
+        """
+        global kernel32, COPYFILE, PARAMS, is_copyfile2
+        if COPYFILE is not None:
+            return COPYFILE
+
+        import ctypes
 
+        kernel32 = ctypes.WinDLL('kernel32',
+                                 use_last_error=True,
+                                 use_errno=True)
+        try:
+            copyfile_func = kernel32.CopyFile2
+            is_copyfile2 = True
+        except AttributeError:
+            # on windows 7 and older
+            copyfile_func = kernel32.CopyFileW
+            is_copyfile2 = False
+
+        copyfile_func.restype = ctypes.HRESULT
+
+        if is_copyfile2:
+            # Skip alternate streams in CopyFile2
+            from ctypes import wintypes
+
+            class COPYFILE2_EXTENDED_PARAMETERS(ctypes.Structure):
+                """
+                typedef struct COPYFILE2_EXTENDED_PARAMETERS {
+                  DWORD                       dwSize;
+                  DWORD                       dwCopyFlags;
+                  BOOL                        *pfCancel;
+                  PCOPYFILE2_PROGRESS_ROUTINE pProgressRoutine;
+                  PVOID                       pvCallbackContext;
+                } COPYFILE2_EXTENDED_PARAMETERS;
+                """
+
+                _fields_ = [
+                    ("dwSize", wintypes.DWORD),
+                    ("dwCopyFlags", wintypes.DWORD),
+                    # The rest isn't actually void, but by making these
+                    # voids the call speed is much faster - especially with
+                    # pProgressRoutine as void instead of WINFUNCTYPE
+                    ("pfCancel", ctypes.c_void_p),
+                    ("pProgressRoutine", ctypes.c_void_p),
+                    ("pvCallbackContext", ctypes.c_void_p)
+                ]
+
+            PARAMS = COPYFILE2_EXTENDED_PARAMETERS()
+            PARAMS.dwSize = ctypes.sizeof(COPYFILE2_EXTENDED_PARAMETERS)
+            PARAMS.dwCopyFlags = 0x00008000  # COPY_FILE_SKIP_ALTERNATE_STREAMS
+            copyfile_func.argtypes = (
+                ctypes.c_wchar_p,
+                ctypes.c_wchar_p,
+                ctypes.POINTER(COPYFILE2_EXTENDED_PARAMETERS)
+            )
+
+        else:
+            copyfile_func.argtypes = (ctypes.c_wchar_p,
+                                      ctypes.c_wchar_p,
+                                      ctypes.c_void_p)
+            PARAMS = None
+
+        COPYFILE = copyfile_func
+        return COPYFILE
 
     def copyfile(src, dst, follow_symlinks=True):
         """Copy data from src to dst.
@@ -329,10 +567,21 @@ else:
             if dest_file.startswith('\\\\'):
                 dest_file = 'UNC\\' + dest_file[2:]
 
-            ret = COPYFILE('\\\\?\\' + source_file,
-                           '\\\\?\\' + dest_file, PARAMS)
+            if throttle.active():
+                # CopyFile2 copies whole file at once, only files can be
+                # throttled
+                limit = throttle.limiter(
+                    os.stat(os.path.dirname(os.path.abspath(dst))).st_dev)
+                limit.file()
+                if limit.throttled():
+                    limit.transfer(os.path.getsize(src))
+
+            copy_func = _init_copyfile()
+            ret = copy_func('\\\\?\\' + source_file,
+                            '\\\\?\\' + dest_file, PARAMS)
 
             if ret == 0:
+                import ctypes
                 error = ctypes.get_last_error()
                 if error == 0:
                     return dst
@@ -346,6 +595,15 @@ else:
                         src, ctypes.FormatError(error)))
         return dst
 
+    def _reflink(src, dst):
+        """Reflinks are not supported on Windows.
+
+        Returns:
+            bool: Always False.
+
+        """
+        return False
+
 
 def patch_copyfile():
     """Monkey patch shutil.copyfile()."""
@@ -357,3 +615,6 @@ def patch_copyfile():
 def unpatch_copyfile():
     """Restore original function."""
     shutil.copyfile = shutil._orig_copyfile
+
+
+from .batch import BatchResult, copyfiles, copytree  # noqa: E402,F401
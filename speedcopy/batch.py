@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""Copying of multiple files.
+
+Functions here use :func:`speedcopy.copyfile` for every file. If
+:class:`speedcopy.index.SignatureIndex` is passed, files unchanged since
+the last copy are skipped without accessing the destination and copied
+files are recorded to the index as they are finished, committed in
+chunks of ``INDEX_COMMIT_FILES``.
+
+With ``dedupe`` enabled, files with identical content are copied only once
+and the rest is created as reflinks (or hardlinks) of the first copy.
+Candidates are grouped by size, then by hash of their beginning and only
+then by hash of the whole content.
+
+With more ``workers``, files are copied in parallel as planned by
+:mod:`speedcopy.scheduler`.
+
+"""
+import collections
+import errno
+import functools
+import os
+import shutil
+
+from . import copyfile, _reflink, debug
+from . import scheduler
+
+# bytes hashed to quickly tell apart files of the same size
+PARTIAL_HASH_SIZE = 64 * 1024
+# copied files are committed to index in transactions of this size
+INDEX_COMMIT_FILES = 1000
+
+_DEDUPE_MODES = (None, "reflink", "hardlink")
+
+
+class BatchResult(object):
+    """Summary of batch copy.
+
+    Attributes:
+        copied (list): Destination files copied.
+        skipped (list): Destination files skipped as up to date.
+        deduplicated (list): Destination files created as links to
+            identical file copied in the same batch.
+        bytes_copied (int): Number of bytes copied.
+        bytes_deduplicated (int): Number of bytes not copied thanks to
+            deduplication.
+        makespan (float): Time spent copying in seconds.
+        lower_bound (float): Theoretical lower bound of ``makespan``
+            with given number of workers.
+
+    """
+
+    def __init__(self):
+        """Initialize empty result."""
+        self.copied = []
+        self.skipped = []
+        self.deduplicated = []
+        self.bytes_copied = 0
+        self.bytes_deduplicated = 0
+        self.makespan = 0.0
+        self.lower_bound = 0.0
+
+    def __repr__(self):
+        """Get short summary."""
+        return ("<BatchResult copied={} skipped={} deduplicated={} "
+                "bytes_copied={} bytes_deduplicated={}>").format(
+                    len(self.copied), len(self.skipped),
+                    len(self.deduplicated), self.bytes_copied,
+                    self.bytes_deduplicated)
+
+
+class _NoIndex(object):
+    """Stand-in used when no index is passed."""
+
+    def is_current(self, src_stat, dst):
+        """Nothing is up to date without index."""
+        return False
+
+    def record_many(self, entries):
+        """Nothing to record."""
+
+    def transaction(self):
+        """Return dummy context manager."""
+        return self
+
+    def __enter__(self):
+        """Do nothing."""
+        return self
+
+    def __exit__(self, *args):
+        """Do nothing."""
+
+
+def _hash(path, limit=None):
+    """Get hex digest of file content (or its first ``limit`` bytes)."""
+    import hashlib
+
+    h = getattr(hashlib, "blake2b", hashlib.sha256)()
+    with open(path, "rb") as f:
+        if limit is not None:
+            h.update(f.read(limit))
+        else:
+            for buf in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(buf)
+    return h.hexdigest()
+
+
+def _dedupe_groups(items):
+    """Group files with identical content.
+
+    Args:
+        items (list): ``(src, dst, stat)`` tuples.
+
+    Yields:
+        tuple: List of items with identical content and hex digest of the
+            content (None if it was not needed to compute it).
+
+    """
+    by_size = collections.OrderedDict()
+    for item in items:
+        by_size.setdefault(item[2].st_size, []).append(item)
+
+    for size, same_size in by_size.items():
+        if size == 0 or len(same_size) == 1:
+            for item in same_size:
+                yield [item], None
+            continue
+
+        # the same source copied to multiple destinations
+        by_inode = collections.OrderedDict()
+        for item in same_size:
+            by_inode.setdefault(
+                (item[2].st_dev, item[2].st_ino), []).append(item)
+        if len(by_inode) == 1:
+            yield same_size, None
+            continue
+
+        by_partial = collections.OrderedDict()
+        for group in by_inode.values():
+            by_partial.setdefault(
+                _hash(group[0][0], PARTIAL_HASH_SIZE), []).append(group)
+        for digest, groups in by_partial.items():
+            if size <= PARTIAL_HASH_SIZE:
+                # partial hash covers the whole content
+                yield [item for group in groups for item in group], digest
+                continue
+            if len(groups) == 1:
+                yield groups[0], None
+                continue
+            by_full = collections.OrderedDict()
+            for group in groups:
+                by_full.setdefault(_hash(group[0][0]), []).extend(group)
+            for digest, group in by_full.items():
+                yield group, digest
+
+
+def _unshare(dst, src_st):
+    """Remove ``dst`` if it is hardlinked to other files.
+
+    Copies are written into existing destination in place, with inode
+    shared by hardlinks (from previous hardlink dedupe) it would
+    overwrite other destinations as well.
+
+    Raises:
+        shutil.SameFileError: if ``dst`` is the source itself (stat as
+            ``src_st``), it is never removed.
+
+    """
+    try:
+        st = os.lstat(dst)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return
+    if (st.st_dev, st.st_ino) == (src_st.st_dev, src_st.st_ino):
+        SameFileError = getattr(shutil, "SameFileError", shutil.Error)
+        raise SameFileError("{!r} is the source file".format(dst))
+    if st.st_nlink > 1:
+        debug(">>> unlinking hardlinked {}".format(dst))
+        os.remove(dst)
+
+
+def _link(src, dst, dedupe):
+    """Create ``dst`` as link to identical ``src``.
+
+    Returns:
+        bool: True on success, False if link cannot be created.
+
+    """
+    if dedupe == "hardlink":
+        try:
+            os.remove(dst)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        try:
+            os.link(src, dst)
+            return True
+        except OSError as e:
+            debug("!!! hardlink failed: {}".format(e))
+    return _reflink(src, dst)
+
+
+def _copy_group(group, dedupe):
+    """Copy group of identical files.
+
+    Args:
+        group (tuple): List of ``(src, dst, stat)`` tuples and digest
+            of their content.
+        dedupe (str): Deduplication mode, see :func:`copyfiles`.
+
+    Returns:
+        list: ``(dst, stat, digest, linked)`` tuple for every file.
+
+    """
+    items, digest = group
+    first_dst = items[0][1]
+    done = []
+    for i, (src, dst, st) in enumerate(items):
+        _unshare(dst, st)
+        linked = bool(i) and _link(first_dst, dst, dedupe)
+        if not linked:
+            copyfile(src, dst)
+        done.append((dst, st, digest, linked))
+    return done
+
+
+def copyfiles(pairs, index=None, dedupe=None, workers=1):
+    """Copy multiple files.
+
+    Args:
+        pairs (iterable): ``(src, dst)`` tuples of files to copy.
+        index (speedcopy.index.SignatureIndex, optional): Index used to
+            skip files not changed since last copy. Copied files are
+            recorded to it.
+        dedupe (str, optional): Copy identical files only once and create
+            the rest as ``"reflink"`` of it. With ``"hardlink"`` hardlinks
+            are created instead. Files are copied if links cannot be
+            created (different filesystems, no support). Existing
+            destinations hardlinked to other files are always replaced,
+            never written in place.
+        workers (int): Number of files copied in parallel.
+
+    Returns:
+        BatchResult: Summary of copied and skipped files.
+
+    Raises:
+        ValueError: if ``dedupe`` or ``workers`` is invalid.
+        OSError: if source cannot be read or destination written. Files
+            copied before the error are recorded to index.
+
+    """
+    if dedupe not in _DEDUPE_MODES:
+        raise ValueError("Invalid dedupe mode {!r}".format(dedupe))
+    if workers < 1:
+        raise ValueError("Invalid number of workers {!r}".format(workers))
+    index = index if index is not None else _NoIndex()
+    result = BatchResult()
+    todo = []
+    for src, dst in pairs:
+        st = os.stat(src)
+        if index.is_current(st, dst):
+            result.skipped.append(dst)
+        else:
+            todo.append((src, dst, st))
+
+    if dedupe:
+        groups = list(_dedupe_groups(todo))
+    else:
+        groups = [([item], None) for item in todo]
+
+    pending = []
+
+    def flush():
+        with index.transaction():
+            index.record_many(pending)
+        del pending[:]
+
+    def finished(done):
+        for dst, st, digest, linked in (f for group in done for f in group):
+            if linked:
+                result.deduplicated.append(dst)
+                result.bytes_deduplicated += st.st_size
+            else:
+                result.copied.append(dst)
+                result.bytes_copied += st.st_size
+            pending.append((dst, st, None, digest))
+        if len(pending) >= INDEX_COMMIT_FILES:
+            flush()
+
+    # links are cheap, group costs as much as its first file
+    tasks = scheduler.plan(groups, [g[0][0][2].st_size for g in groups])
+    try:
+        _, stats = scheduler.run(
+            tasks, functools.partial(_copy_group, dedupe=dedupe), workers,
+            callback=finished)
+    finally:
+        flush()
+    result.makespan = stats.makespan
+    result.lower_bound = stats.lower_bound
+    return result
+
+
+def _walk_pairs(src, dst):
+    """Create directories of ``dst`` tree and yield files to copy."""
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        dst_root = os.path.normpath(os.path.join(dst, rel))
+        if not os.path.isdir(dst_root):
+            os.makedirs(dst_root)
+        for name in files:
+            yield os.path.join(root, name), os.path.join(dst_root, name)
+
+
+def copytree(src, dst, index=None, dedupe=None, workers=1):
+    """Copy content of directory tree.
+
+    Only file data are copied (see :func:`speedcopy.copyfile`), existing
+    destination directories are reused.
+
+    Args:
+        src (str): Source directory.
+        dst (str): Destination directory, created if it doesn't exist.
+        index (speedcopy.index.SignatureIndex, optional): See
+            :func:`copyfiles`.
+        dedupe (str, optional): See :func:`copyfiles`.
+        workers (int): Number of files copied in parallel.
+
+    Returns:
+        BatchResult: Summary of copied and skipped files.
+
+    """
+    return copyfiles(_walk_pairs(src, dst), index=index, dedupe=dedupe,
+                     workers=workers)
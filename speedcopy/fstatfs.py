@@ -7,10 +7,38 @@ https://github.com/mithro/rcfiles
 """
 import os
 import ctypes
-import ctypes.util
 
 
-libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_libc = None
+
+
+def get_libc():
+    """Load C library on first use.
+
+    Symbols of already loaded process are tried first as
+    :func:`ctypes.util.find_library` may spawn ``ldconfig`` or ``gcc``
+    subprocesses.
+
+    Returns:
+        ctypes.CDLL: C library.
+
+    """
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, "statfs"):
+            from ctypes.util import find_library
+            libc = ctypes.CDLL(find_library("c"), use_errno=True)
+        _libc = libc
+    return _libc
+
+
+def __getattr__(name):
+    """Keep ``libc`` module attribute loaded lazily (Python 3.7+)."""
+    if name == "libc":
+        return get_libc()
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name))
 
 
 class Fs_types:
@@ -115,6 +143,7 @@ class FilesystemInfo():
 
     def __init__(self):
         """Prepare system calls."""
+        libc = get_libc()
         self._statfs = libc.statfs
         self._statfs.argtypes = [ctypes.c_char_p, ctypes.POINTER(statfs_t)]
         self._statfs.rettype = ctypes.c_int
@@ -145,13 +174,14 @@ class FilesystemInfo():
         """Get information about mounted file system by file descriptor.
 
         Args:
-            fd: A file descriptor.
+            fd (int or IOBase): A file descriptor or an object which has
+                                a :meth:`IOBase.fileno()` function.
         Returns:
             Returns a statfs_t object.
 
         """
         buf = statfs_t()
-        fileno = fd.fileno()
+        fileno = fd if isinstance(fd, int) else fd.fileno()
         assert fileno
         err = self._fstatfs(fileno, ctypes.byref(buf))
         if err == -1:
@@ -163,12 +193,14 @@ class FilesystemInfo():
         """Get the filesystem type a file/path is on.
 
         Args:
-            path_or_fd (str or IOBase): A string path or an object which has
-                                        a :meth:`IOBase.fileno()` function.
+            path_or_fd (str, int or IOBase): A string path, file descriptor
+                                             or an object which has
+                                             a :meth:`IOBase.fileno()`
+                                             function.
         Returns:
             A string name of the file system.
         """
-        if hasattr(path_or_fd, 'fileno'):
+        if isinstance(path_or_fd, int) or hasattr(path_or_fd, 'fileno'):
             buf = self.fstatfs(path_or_fd)
         else:
             buf = self.statfs(path_or_fd)
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""Persistent index of files written by speedcopy.
+
+Index is kept in sqlite3 database. For every destination file it records
+its signature (size, mtime, inode and optionally content hash) together
+with size and mtime of the source it was copied from. Repeated
+synchronization can then decide if file needs to be copied only by
+comparing source stat with the index, without touching the destination
+which is usually on slow network share.
+
+Destination signatures are used by :meth:`SignatureIndex.validate` to
+detect files modified by someone else.
+
+Index can be maintained from command line::
+
+    python -m speedcopy.index index.db validate /mnt/share/project
+    python -m speedcopy.index index.db prune /mnt/share/project
+
+"""
+import argparse
+import collections
+import os
+import sqlite3
+from contextlib import contextmanager
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    hash TEXT,
+    src_size INTEGER NOT NULL,
+    src_mtime INTEGER NOT NULL
+)
+"""
+
+Entry = collections.namedtuple(
+    "Entry", ("path", "size", "mtime", "inode", "hash",
+              "src_size", "src_mtime"))
+
+
+def _mtime(st):
+    """Get modification time in nanoseconds from stat result."""
+    try:
+        return st.st_mtime_ns
+    except AttributeError:
+        # python 2
+        return int(st.st_mtime * 1e9)
+
+
+def _normpath(path):
+    """Get normalized absolute path used as index key."""
+    return os.path.normcase(os.path.abspath(path))
+
+
+class SignatureIndex(object):
+    """Index of destination files written by speedcopy.
+
+    Every call to :meth:`record` or :meth:`remove` is committed
+    immediately unless it is done inside :meth:`transaction` block.
+
+    Args:
+        path (str): Path to database file, created if it doesn't exist.
+
+    """
+
+    def __init__(self, path):
+        """Open or create database."""
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+        self._depth = 0
+
+    def __enter__(self):
+        """Use as context manager closing the database on exit."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the database."""
+        self.close()
+
+    def close(self):
+        """Close the database."""
+        self._conn.close()
+
+    def _commit(self):
+        """Commit changes if not inside transaction."""
+        if not self._depth:
+            self._conn.commit()
+
+    @contextmanager
+    def transaction(self):
+        """Group updates into single transaction.
+
+        Changes are committed at the end of the block or rolled back if
+        exception is raised. Blocks can be nested, only the outermost one
+        commits.
+
+        """
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._depth -= 1
+            if not self._depth:
+                self._conn.rollback()
+            raise
+        self._depth -= 1
+        self._commit()
+
+    def get(self, dst):
+        """Get index entry for destination file.
+
+        Args:
+            dst (str): Destination file.
+
+        Returns:
+            Entry: Recorded signature or None if file is not in index.
+
+        """
+        row = self._conn.execute(
+            "SELECT * FROM files WHERE path = ?",
+            (_normpath(dst),)).fetchone()
+        return Entry(*row) if row else None
+
+    def is_current(self, src_stat, dst):
+        """Check if destination is up to date with source.
+
+        Only the index is consulted, destination is not accessed.
+
+        Args:
+            src_stat (os.stat_result): Stat of the source file.
+            dst (str): Destination file.
+
+        Returns:
+            bool: True if ``dst`` was copied from source of the same size
+                and modification time.
+
+        """
+        row = self._conn.execute(
+            "SELECT src_size, src_mtime FROM files WHERE path = ?",
+            (_normpath(dst),)).fetchone()
+        return row is not None and \
+            row[0] == src_stat.st_size and row[1] == _mtime(src_stat)
+
+    def record(self, dst, src_stat, dst_stat=None, hash=None):
+        """Record destination file written from source.
+
+        Args:
+            dst (str): Destination file.
+            src_stat (os.stat_result): Stat of the source file.
+            dst_stat (os.stat_result, optional): Stat of the destination,
+                ``dst`` is stat-ed if not passed.
+            hash (str, optional): Hash of the file content.
+
+        """
+        self.record_many([(dst, src_stat, dst_stat, hash)])
+
+    def record_many(self, entries):
+        """Record multiple destination files at once.
+
+        Args:
+            entries (iterable): Tuples of arguments of :meth:`record`,
+                ``(dst, src_stat, dst_stat, hash)``.
+
+        """
+        rows = []
+        for dst, src_stat, dst_stat, hash in entries:
+            if dst_stat is None:
+                dst_stat = os.stat(dst)
+            rows.append((_normpath(dst), dst_stat.st_size, _mtime(dst_stat),
+                         dst_stat.st_ino, hash, src_stat.st_size,
+                         _mtime(src_stat)))
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self._commit()
+
+    def remove(self, dst):
+        """Remove destination file from index.
+
+        Args:
+            dst (str): Destination file.
+
+        """
+        self._conn.execute(
+            "DELETE FROM files WHERE path = ?", (_normpath(dst),))
+        self._commit()
+
+    def entries(self, root=None):
+        """Iterate over index entries.
+
+        Args:
+            root (str, optional): Only entries under this directory.
+
+        Yields:
+            Entry: Index entries sorted by path.
+
+        """
+        if root is None:
+            cursor = self._conn.execute("SELECT * FROM files ORDER BY path")
+        else:
+            # range query on prefix, no need to escape LIKE wildcards
+            prefix = os.path.join(_normpath(root), "")
+            cursor = self._conn.execute(
+                "SELECT * FROM files WHERE path >= ? AND path < ? "
+                "ORDER BY path",
+                (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+        for row in cursor.fetchall():
+            yield Entry(*row)
+
+    def validate(self, root=None):
+        """Detect destination files modified or removed outside speedcopy.
+
+        Destinations are stat-ed and compared with recorded size, mtime
+        and inode. Entries not matching are removed from index so they
+        are copied again on next synchronization.
+
+        Args:
+            root (str, optional): Only validate files under this directory.
+
+        Returns:
+            list: Paths of invalid destination files.
+
+        """
+        invalid = []
+        for entry in self.entries(root):
+            try:
+                st = os.stat(entry.path)
+            except OSError:
+                invalid.append(entry.path)
+                continue
+            if (st.st_size, _mtime(st), st.st_ino) != \
+                    (entry.size, entry.mtime, entry.inode):
+                invalid.append(entry.path)
+        self._delete(invalid)
+        return invalid
+
+    def prune(self, root=None):
+        """Remove entries of destination files which no longer exist.
+
+        Args:
+            root (str, optional): Only prune files under this directory.
+
+        Returns:
+            list: Paths removed from index.
+
+        """
+        missing = [entry.path for entry in self.entries(root)
+                   if not os.path.lexists(entry.path)]
+        self._delete(missing)
+        return missing
+
+    def _delete(self, paths):
+        """Remove entries of given (normalized) paths."""
+        self._conn.executemany(
+            "DELETE FROM files WHERE path = ?", [(p,) for p in paths])
+        self._commit()
+
+
+def main(argv=None):
+    """Maintain index from command line."""
+    parser = argparse.ArgumentParser(prog="python -m speedcopy.index")
+    parser.add_argument("index", help="path to index database")
+    parser.add_argument("command", choices=("validate", "prune"))
+    parser.add_argument("root", nargs="?", default=None,
+                        help="process only files under this directory")
+    args = parser.parse_args(argv)
+
+    with SignatureIndex(args.index) as index:
+        paths = getattr(index, args.command)(args.root)
+    for path in paths:
+        print(path)
+    print("{} entries removed".format(len(paths)))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""Size-aware scheduling of multi-file operations.
+
+Work is ordered longest-processing-time-first (LPT) using file sizes known
+from scanning, so large files are started first and one huge file doesn't
+keep single worker running long after all the others have finished. Small
+files are packed into batches so the task dispatch overhead is paid once
+per batch and not once per file. Large files are always scheduled alone
+and go through :func:`speedcopy.copyfile` which offloads them to the
+kernel or server (``sendfile``, server-side copy).
+
+Quality of the schedule is reported as makespan (wall time) together with
+its theoretical lower bound - the larger of the longest task and the total
+work divided by the number of workers.
+
+"""
+import time
+
+# files up to this size (in bytes) are packed into batches
+SMALL_FILE_SIZE = 1024 * 1024
+# maximum number of files and bytes in one batch
+BATCH_FILES = 64
+BATCH_BYTES = 8 * 1024 * 1024
+# fixed cost of processing one file expressed in bytes (open, stat, ...)
+FILE_COST = 64 * 1024
+
+_monotonic = getattr(time, "monotonic", time.time)
+
+
+class ScheduleStats(object):
+    """Statistics of executed schedule.
+
+    Attributes:
+        workers (int): Number of workers.
+        tasks (int): Number of executed tasks.
+        makespan (float): Wall time of the whole run in seconds.
+        lower_bound (float): Theoretical lower bound of makespan in seconds.
+
+    """
+
+    def __init__(self, workers, tasks, makespan, lower_bound):
+        """Initialize statistics."""
+        self.workers = workers
+        self.tasks = tasks
+        self.makespan = makespan
+        self.lower_bound = lower_bound
+
+    def __repr__(self):
+        """Get short summary."""
+        return ("<ScheduleStats workers={} tasks={} makespan={:.4f} "
+                "lower_bound={:.4f}>").format(
+                    self.workers, self.tasks, self.makespan,
+                    self.lower_bound)
+
+
+def plan(units, sizes, small_size=SMALL_FILE_SIZE, batch_files=BATCH_FILES,
+         batch_bytes=BATCH_BYTES):
+    """Split work units into tasks ordered largest first.
+
+    Args:
+        units (list): Work units (for example files to copy).
+        sizes (list): Size of every unit in bytes.
+        small_size (int): Units up to this size are batched.
+        batch_files (int): Maximum number of units in one batch.
+        batch_bytes (int): Maximum size of one batch in bytes.
+
+    Returns:
+        list: Tasks as lists of units, ordered by estimated cost from
+            the most expensive.
+
+    """
+    tasks = []
+    small = []
+    for unit, size in zip(units, sizes):
+        if size > small_size:
+            tasks.append((size + FILE_COST, [unit]))
+        else:
+            small.append((size, unit))
+
+    # pack small units largest first so batches have similar cost
+    small.sort(key=lambda item: item[0], reverse=True)
+    batch = []
+    batch_size = 0
+    for size, unit in small:
+        if batch and (len(batch) >= batch_files
+                      or batch_size + size > batch_bytes):
+            tasks.append((batch_size + len(batch) * FILE_COST, batch))
+            batch = []
+            batch_size = 0
+        batch.append(unit)
+        batch_size += size
+    if batch:
+        tasks.append((batch_size + len(batch) * FILE_COST, batch))
+
+    tasks.sort(key=lambda task: task[0], reverse=True)
+    return [task for _, task in tasks]
+
+
+def run(tasks, func, workers=1, callback=None):
+    """Execute tasks.
+
+    Tasks are handed to workers one by one in given order, so every
+    worker takes the next task as soon as it is free (greedy list
+    scheduling, with tasks from :func:`plan` it is LPT).
+
+    Args:
+        tasks (list): Tasks as lists of units.
+        func (callable): Function called for every unit.
+        workers (int): Number of worker threads.
+        callback (callable, optional): Called in the calling thread with
+            list of ``func`` results of every task as soon as the task
+            is finished. Results are not collected then. When ``func``
+            fails, it is still called with results of units finished
+            before the failure.
+
+    Returns:
+        tuple: List of ``func`` results (in no particular order when
+            running in parallel, empty with ``callback``) and
+            :class:`ScheduleStats`.
+
+    """
+    def timed(task):
+        start = _monotonic()
+        results = []
+        try:
+            for unit in task:
+                results.append(func(unit))
+        except Exception as e:
+            return results, _monotonic() - start, e
+        return results, _monotonic() - start, None
+
+    results = []
+    durations = []
+
+    def finished(done):
+        task_results, duration, error = done
+        durations.append(duration)
+        if callback is None:
+            results.extend(task_results)
+        else:
+            callback(task_results)
+        if error is not None:
+            raise error
+
+    start = _monotonic()
+    if workers > 1 and len(tasks) > 1:
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(workers)
+        try:
+            for done in pool.imap_unordered(timed, tasks, chunksize=1):
+                finished(done)
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            finished(timed(task))
+    makespan = _monotonic() - start
+
+    lower_bound = max([sum(durations) / workers] + durations)
+    return results, ScheduleStats(workers, len(tasks), makespan, lower_bound)
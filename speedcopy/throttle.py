@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""Bandwidth and IOPS throttling.
+
+Limits in bytes/s and files/s can be set globally and for every
+destination mount (identified by device id of any path on it). They are
+enforced by token buckets at chunk granularity inside the copy loops, so
+throttled copy progresses smoothly instead of in bursts. Limits can be
+changed, added or removed at any time, copies in progress (even those
+already waiting or started without limit) pick them up with the next
+chunk::
+
+    from speedcopy import throttle
+
+    throttle.set_rate_limit(bytes_per_sec=50 * 1024 ** 2)
+    throttle.set_rate_limit(files_per_sec=200, mount="/mnt/filer")
+
+When no limit is set, copying only checks for new limits between chunks
+of data (see :func:`limiter`).
+
+"""
+import os
+import threading
+import time
+
+# data are copied in chunks of this size when throttled
+CHUNK_SIZE = 256 * 1024
+# bucket capacity as a fraction of rate per second
+BURST_SECONDS = 0.1
+
+_monotonic = getattr(time, "monotonic", time.time)
+
+_lock = threading.Lock()
+# global buckets
+_global = {}
+# buckets per destination device, {st_dev: {kind: TokenBucket}}
+_mounts = {}
+# True if there is any limit
+_active = False
+# incremented on every change of limits
+_generation = 0
+# default of set_rate_limit arguments, keeps current limit
+_UNCHANGED = object()
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter.
+
+    Tokens are refilled continuously with given ``rate`` up to capacity
+    of ``rate * BURST_SECONDS``. Consuming more tokens than available
+    puts the bucket into debt and the caller waits until its part is
+    repaid, so chunks larger than the capacity are allowed. Waiting
+    callers are woken up when rate changes and continue with the new
+    rate (or immediately if the bucket was disabled).
+
+    Args:
+        rate (float): Tokens per second.
+
+    """
+
+    def __init__(self, rate):
+        """Create full bucket."""
+        self._cond = threading.Condition()
+        self.rate = None
+        self.capacity = 0
+        self._stamp = _monotonic()
+        # tokens ever consumed and granted, available tokens are
+        # the difference
+        self._consumed = 0
+        self._granted = 0
+        self.set_rate(rate)
+        self._granted = self.capacity
+
+    def _refill(self):
+        """Grant tokens for time elapsed since last refill."""
+        now = _monotonic()
+        if self.rate:
+            self._granted = min(
+                self._granted + (now - self._stamp) * self.rate,
+                self._consumed + self.capacity)
+        self._stamp = now
+
+    def set_rate(self, rate):
+        """Change rate.
+
+        Args:
+            rate (float): Tokens per second, None disables the bucket.
+
+        Raises:
+            ValueError: if ``rate`` is not positive.
+
+        """
+        _check_rate(rate)
+        with self._cond:
+            # tokens up to now are granted with the old rate
+            self._refill()
+            self.rate = rate
+            if rate:
+                self.capacity = max(rate * BURST_SECONDS, 1)
+            self._cond.notify_all()
+
+    def consume(self, tokens):
+        """Take tokens, wait if there are not enough of them.
+
+        Args:
+            tokens (int): Number of tokens.
+
+        """
+        with self._cond:
+            if not self.rate:
+                return
+            self._refill()
+            self._consumed += tokens
+            end = self._consumed
+            while self.rate and self._granted < end:
+                self._cond.wait((end - self._granted) / self.rate)
+                self._refill()
+
+
+class Limiter(object):
+    """Limits applied to one copy.
+
+    Buckets are looked up again when limits are changed, so limits added
+    (or removed) later apply to copy in progress from its next chunk.
+
+    Args:
+        dev (int): Device id (``st_dev``) of destination.
+
+    Attributes:
+        byte_buckets (list): Buckets limiting bytes/s.
+        file_buckets (list): Buckets limiting files/s.
+
+    """
+
+    def __init__(self, dev):
+        """Initialize limiter."""
+        self.dev = dev
+        self.byte_buckets = []
+        self.file_buckets = []
+        self._generation = None
+        self._resolve()
+
+    def _resolve(self):
+        """Look up buckets if limits changed since the last time."""
+        if self._generation == _generation:
+            return
+        with _lock:
+            buckets = [_global, _mounts.get(self.dev, {})]
+            self.byte_buckets = [b["bytes"] for b in buckets if "bytes" in b]
+            self.file_buckets = [b["files"] for b in buckets if "files" in b]
+            self._generation = _generation
+
+    def throttled(self):
+        """Check if copy is limited.
+
+        Returns:
+            bool: True if there is any limit for the destination.
+
+        """
+        self._resolve()
+        return bool(self.byte_buckets or self.file_buckets)
+
+    def chunk_size(self, size):
+        """Get size of the next chunk of data to copy.
+
+        Args:
+            size (int): Chunk size used without bytes/s limit.
+
+        Returns:
+            int: ``size`` or :data:`CHUNK_SIZE` if bytes/s are limited.
+
+        """
+        self._resolve()
+        return min(size, CHUNK_SIZE) if self.byte_buckets else size
+
+    def file(self):
+        """Account one file."""
+        self._resolve()
+        for bucket in self.file_buckets:
+            bucket.consume(1)
+
+    def transfer(self, size):
+        """Account transferred bytes.
+
+        Bytes are accounted to buckets found by the last call of
+        :meth:`chunk_size`, so data sent before a limit was added are
+        not charged to it.
+
+        Args:
+            size (int): Number of bytes.
+
+        """
+        for bucket in self.byte_buckets:
+            bucket.consume(size)
+
+
+def _check_rate(rate):
+    """Raise ValueError if rate is not None or positive number."""
+    if rate is not None and not rate > 0:
+        raise ValueError("Invalid rate {!r}, use None for no limit".format(
+            rate))
+
+
+def _update(buckets, kind, rate):
+    """Set rate of bucket of given kind, create or remove it as needed."""
+    bucket = buckets.get(kind)
+    if bucket is not None:
+        # copies in progress hold reference to it
+        bucket.set_rate(rate)
+        if not rate:
+            del buckets[kind]
+    elif rate:
+        buckets[kind] = TokenBucket(rate)
+
+
+def set_rate_limit(bytes_per_sec=_UNCHANGED, files_per_sec=_UNCHANGED,
+                   mount=None):
+    """Set or change rate limit.
+
+    Limits not passed are kept as they are.
+
+    Args:
+        bytes_per_sec (float, optional): Maximum bytes/s, None for no limit.
+        files_per_sec (float, optional): Maximum files/s, None for no limit.
+        mount (str, optional): Path on destination mount the limit applies
+            to. Global limit is set if not specified.
+
+    Raises:
+        OSError: if ``mount`` doesn't exist.
+        ValueError: if rate is not positive.
+
+    """
+    global _active, _generation
+    rates = [(kind, rate) for kind, rate in (("bytes", bytes_per_sec),
+                                             ("files", files_per_sec))
+             if rate is not _UNCHANGED]
+    for _, rate in rates:
+        _check_rate(rate)
+    dev = None if mount is None else os.stat(mount).st_dev
+    with _lock:
+        buckets = _global if dev is None else _mounts.setdefault(dev, {})
+        for kind, rate in rates:
+            _update(buckets, kind, rate)
+        if dev is not None and not buckets:
+            del _mounts[dev]
+        _active = bool(_global or _mounts)
+        _generation += 1
+
+
+def clear_rate_limits():
+    """Remove all rate limits."""
+    global _active, _generation
+    with _lock:
+        for buckets in [_global] + list(_mounts.values()):
+            for kind in list(buckets):
+                _update(buckets, kind, None)
+        _mounts.clear()
+        _active = False
+        _generation += 1
+
+
+def active():
+    """Check if any rate limit is set.
+
+    Returns:
+        bool: True if copies can be throttled.
+
+    """
+    return _active
+
+
+def limiter(dev):
+    """Get limiter for copy to given destination device.
+
+    Args:
+        dev (int): Device id (``st_dev``) of destination.
+
+    Returns:
+        Limiter: Limiter following current and future limits of ``dev``.
+
+    """
+    return Limiter(dev)
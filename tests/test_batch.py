@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""Tests for copying of multiple files."""
+
+import os
+import shutil
+
+import pytest
+
+import speedcopy
+from speedcopy import batch
+from speedcopy.index import SignatureIndex
+
+
+def _write(path, data):
+    """Write data to file."""
+    with open(str(path), "wb") as f:
+        f.write(data)
+
+
+def _read(path):
+    """Read data from file."""
+    with open(str(path), "rb") as f:
+        return f.read()
+
+
+def _make_duplicates(src):
+    """Create tree with duplicate files, return expected bytes avoided."""
+    src.mkdir()
+    big = os.urandom(batch.PARTIAL_HASH_SIZE * 2)
+    small = os.urandom(1024)
+    _write(src.join("big1"), big)
+    _write(src.join("big2"), big)
+    # same size and beginning, different tail
+    changed = bytearray(big)
+    changed[-1] ^= 0xFF
+    _write(src.join("big3"), bytes(changed))
+    _write(src.join("small1"), small)
+    _write(src.join("small2"), small)
+    _write(src.join("other"), os.urandom(1024))
+    _write(src.join("empty1"), b"")
+    _write(src.join("empty2"), b"")
+    return len(big) + len(small)
+
+
+@pytest.mark.skipif(not hasattr(os, "link"), reason="no hardlinks")
+def test_dedupe_hardlink(tmpdir):
+    """Test identical files are hardlinked."""
+    src = tmpdir.join("src")
+    dst = tmpdir.join("dst")
+    avoided = _make_duplicates(src)
+
+    result = speedcopy.copytree(str(src), str(dst), dedupe="hardlink")
+
+    assert result.bytes_deduplicated == avoided
+    assert len(result.deduplicated) == 2
+    assert len(result.copied) == 6
+    for name in os.listdir(str(src)):
+        assert _read(dst.join(name)) == _read(src.join(name))
+    assert os.stat(str(dst.join("big1"))).st_ino == \
+        os.stat(str(dst.join("big2"))).st_ino
+    assert os.stat(str(dst.join("big1"))).st_ino != \
+        os.stat(str(dst.join("big3"))).st_ino
+
+
+def test_dedupe_reflink(tmpdir):
+    """Test reflink dedupe falls back to copy where not supported."""
+    src = tmpdir.join("src")
+    dst = tmpdir.join("dst")
+    avoided = _make_duplicates(src)
+
+    result = speedcopy.copytree(str(src), str(dst), dedupe="reflink")
+
+    assert result.bytes_deduplicated in (0, avoided)
+    assert result.bytes_copied + result.bytes_deduplicated == \
+        sum(os.path.getsize(str(src.join(n))) for n in os.listdir(str(src)))
+    for name in os.listdir(str(src)):
+        assert _read(dst.join(name)) == _read(src.join(name))
+        assert not os.path.samefile(str(dst.join(name)), str(src.join(name)))
+
+
+def test_dedupe_invalid(tmpdir):
+    """Test invalid dedupe mode."""
+    with pytest.raises(ValueError):
+        speedcopy.copyfiles([], dedupe="symlink")
+
+
+def _make_pair_tree(src):
+    """Create two identical source files."""
+    src.mkdir()
+    data = os.urandom(4096)
+    _write(src.join("a"), data)
+    _write(src.join("b"), data)
+
+
+@pytest.mark.skipif(not hasattr(os, "link"), reason="no hardlinks")
+@pytest.mark.parametrize("use_index", [False, True])
+def test_resync_after_hardlink_dedupe(tmpdir, use_index):
+    """Test re-sync doesn't write through hardlinks of deduplicated files."""
+    src = tmpdir.join("src")
+    dst = tmpdir.join("dst")
+    _make_pair_tree(src)
+    index = SignatureIndex(str(tmpdir.join("index.db"))) if use_index \
+        else None
+
+    result = speedcopy.copytree(str(src), str(dst), index=index,
+                                dedupe="hardlink")
+    assert len(result.deduplicated) == 1
+
+    _write(src.join("a"), b"changed")
+    result = speedcopy.copytree(str(src), str(dst), index=index)
+    if use_index:
+        assert result.copied == [str(dst.join("a"))]
+        assert index.validate(str(dst)) == []
+        index.close()
+
+    for name in ("a", "b"):
+        assert _read(dst.join(name)) == _read(src.join(name))
+
+
+def test_copy_hardlinked_to_itself(tmpdir):
+    """Test copy of hardlinked file to itself is refused, not removed."""
+    src = tmpdir.join("a")
+    _write(src, b"data")
+    os.link(str(src), str(tmpdir.join("a_link")))
+
+    with pytest.raises(shutil.SameFileError):
+        speedcopy.copyfiles([(str(src), str(src))])
+    assert _read(src) == b"data"
+    assert os.stat(str(src)).st_nlink == 2
+
+
+@pytest.mark.parametrize("clone", [False, True])
+def test_dedupe_reflink_separate_copies(tmpdir, monkeypatch, clone):
+    """Test reflink dedupe (or its fallback) keeps destinations separate."""
+    def fake_reflink(src, dst):
+        if not clone:
+            return False
+        # clone has its own inode, written in place like FICLONE does
+        _write(dst, _read(src))
+        return True
+
+    monkeypatch.setattr(batch, "_reflink", fake_reflink)
+    src = tmpdir.join("src")
+    dst = tmpdir.join("dst")
+    avoided = _make_duplicates(src)
+
+    result = speedcopy.copytree(str(src), str(dst), dedupe="reflink")
+
+    assert result.bytes_deduplicated == (avoided if clone else 0)
+    names = sorted(os.listdir(str(src)))
+    inodes = set(os.stat(str(dst.join(name))).st_ino for name in names)
+    assert len(inodes) == len(names)
+    for name in names:
+        assert _read(dst.join(name)) == _read(src.join(name))
+
+    # re-run over existing destinations
+    _write(src.join("big1"), b"changed")
+    speedcopy.copytree(str(src), str(dst), dedupe="reflink")
+    for name in names:
+        assert _read(dst.join(name)) == _read(src.join(name))
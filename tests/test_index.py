@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Tests for speedcopy signature index."""
+
+import os
+
+import pytest
+
+import speedcopy
+from speedcopy.index import SignatureIndex, main
+
+
+def _make_tree(root, count=3):
+    """Create source tree with some files."""
+    os.makedirs(os.path.join(str(root), "sub"))
+    for i in range(count):
+        with open(os.path.join(str(root), "sub", "f{}".format(i)), "wb") as f:
+            f.write(os.urandom(1024 * (i + 1)))
+
+
+def test_resync_skips_unchanged(tmpdir):
+    """Test second copy of unchanged tree does not copy anything."""
+    src = tmpdir.join("src")
+    dst = tmpdir.join("dst")
+    _make_tree(src)
+
+    with SignatureIndex(str(tmpdir.join("index.db"))) as index:
+        result = speedcopy.copytree(str(src), str(dst), index=index)
+        assert len(result.copied) == 3
+        entry = index.get(str(dst.join("sub", "f1")))
+        assert entry.size == 2048
+        assert entry.inode == os.stat(str(dst.join("sub", "f1"))).st_ino
+
+    with SignatureIndex(str(tmpdir.join("index.db"))) as index:
+        result = speedcopy.copytree(str(src), str(dst), index=index)
+        assert result.copied == []
+        assert len(result.skipped) == 3
+
+        # change source
+        with open(str(src.join("sub", "f0")), "ab") as f:
+            f.write(b"more")
+        result = speedcopy.copytree(str(src), str(dst), index=index)
+        assert result.copied == [str(dst.join("sub", "f0"))]
+        assert result.bytes_copied == 1028
+
+
+def test_validate_and_prune(tmpdir):
+    """Test detection of external modifications and pruning."""
+    src = tmpdir.join("src")
+    dst = tmpdir.join("dst")
+    _make_tree(src)
+    db = str(tmpdir.join("index.db"))
+
+    with SignatureIndex(db) as index:
+        speedcopy.copytree(str(src), str(dst), index=index)
+        with open(str(dst.join("sub", "f0")), "ab") as f:
+            f.write(b"modified")
+        os.remove(str(dst.join("sub", "f1")))
+
+        assert index.validate(str(tmpdir.join("elsewhere"))) == []
+        invalid = index.validate(str(dst))
+        assert sorted(os.path.basename(p) for p in invalid) == ["f0", "f1"]
+        assert index.get(str(dst.join("sub", "f0"))) is None
+
+        result = speedcopy.copytree(str(src), str(dst), index=index)
+        assert len(result.copied) == 2
+
+    os.remove(str(dst.join("sub", "f2")))
+    assert main([db, "prune"]) == 0
+    with SignatureIndex(db) as index:
+        assert len(list(index.entries())) == 2
+
+
+def test_transaction_rollback(tmpdir):
+    """Test failed transaction does not record anything."""
+    src = tmpdir.join("src")
+    _make_tree(src)
+    f0 = str(src.join("sub", "f0"))
+
+    with SignatureIndex(str(tmpdir.join("index.db"))) as index:
+        with pytest.raises(RuntimeError):
+            with index.transaction():
+                index.record(f0, os.stat(f0))
+                with index.transaction():
+                    index.record(str(src.join("sub", "f1")), os.stat(f0))
+                assert len(list(index.entries())) == 2
+                raise RuntimeError("failed")
+        assert list(index.entries()) == []
+
+
+def test_failed_batch_records_finished(tmpdir, monkeypatch):
+    """Test files copied before failure are recorded and committed."""
+    monkeypatch.setattr(speedcopy.batch, "INDEX_COMMIT_FILES", 2)
+    src = tmpdir.join("src")
+    _make_tree(src, count=4)
+    # copied largest first, the smallest one fails
+    pairs = [(str(src.join("sub", "f{}".format(i))), str(tmpdir.join(name)))
+             for i, name in enumerate(["missing/d", "c", "b", "a"])]
+    db = str(tmpdir.join("index.db"))
+
+    with SignatureIndex(db) as index:
+        with pytest.raises((IOError, OSError)):
+            speedcopy.copyfiles(pairs, index=index)
+        # seen by another connection, so committed
+        with SignatureIndex(db) as other:
+            assert sorted(os.path.basename(e.path)
+                          for e in other.entries()) == ["a", "b", "c"]
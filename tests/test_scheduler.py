@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Tests for scheduling of multi-file operations."""
+
+import os
+
+import pytest
+
+import speedcopy
+from speedcopy import scheduler
+
+
+def test_plan_largest_first():
+    """Test large units go alone largest first, small ones are batched."""
+    mb = 1024 * 1024
+    units = ["s{}".format(i) for i in range(10)] + ["L1", "L2", "L3"]
+    sizes = [1024] * 10 + [2 * mb, 100 * mb, 10 * mb]
+
+    tasks = scheduler.plan(units, sizes, batch_files=4)
+
+    assert tasks[:3] == [["L2"], ["L3"], ["L1"]]
+    assert [len(task) for task in tasks[3:]] == [4, 4, 2]
+    assert sorted(u for task in tasks for u in task) == sorted(units)
+
+
+def test_plan_batch_bytes():
+    """Test batches are limited by size."""
+    tasks = scheduler.plan(list("abcd"), [600, 500, 400, 100],
+                           batch_bytes=1000)
+
+    # per-file cost makes the batch of three more expensive
+    assert tasks == [["b", "c", "d"], ["a"]]
+
+
+def test_run_stats():
+    """Test makespan is reported with its lower bound."""
+    results, stats = scheduler.run([[1, 2], [3], [4]], lambda u: u * 2,
+                                   workers=2)
+
+    assert sorted(results) == [2, 4, 6, 8]
+    assert stats.tasks == 3
+    assert 0 <= stats.lower_bound <= stats.makespan
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_run_callback_on_failure(workers):
+    """Test callback gets results of units finished before failure."""
+    def func(unit):
+        if unit == 3:
+            raise ValueError(unit)
+        return unit
+
+    done = []
+    with pytest.raises(ValueError):
+        scheduler.run([[1, 2, 3, 4], [5]], func, workers=workers,
+                      callback=done.append)
+    assert [1, 2] in done
+
+
+def test_parallel_copytree(tmpdir):
+    """Test parallel copy of mixed file sizes."""
+    src = tmpdir.join("src")
+    src.mkdir()
+    sizes = [10, 100, 1024, 4096] * 25 + [3 * 1024 * 1024, 2 * 1024 * 1024]
+    for i, size in enumerate(sizes):
+        with open(str(src.join("f{}".format(i))), "wb") as f:
+            f.write(os.urandom(size))
+
+    result = speedcopy.copytree(str(src), str(tmpdir.join("dst")),
+                                workers=4)
+
+    assert len(result.copied) == len(sizes)
+    assert result.bytes_copied == sum(sizes)
+    assert 0 < result.lower_bound <= result.makespan
+    for i in range(len(sizes)):
+        name = "f{}".format(i)
+        with open(str(src.join(name)), "rb") as f1, \
+                open(str(tmpdir.join("dst", name)), "rb") as f2:
+            assert f1.read() == f2.read()
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 """Tests for speedcopy."""
 
+import collections
 import shutil
 import speedcopy
 import os
+import subprocess
+import sys
 import pytest
 
 
@@ -121,3 +124,131 @@ def test_unpatch():
     """Test if copyfile is restored."""
     speedcopy.unpatch_copyfile()
     assert shutil.copyfile == shutil._orig_copyfile
+
+
+@pytest.mark.skipif(sys.platform.startswith("win32"),
+                    reason="small-file fast path is not used on Windows")
+def test_small_file_syscalls(tmpdir, monkeypatch):
+    """Test syscall budget of small-file fast path."""
+    from speedcopy.fstatfs import FilesystemInfo
+
+    data = os.urandom(4 * 1024)
+    for name in ("warmup", "source"):
+        with open(str(tmpdir.join(name)), "wb") as f:
+            f.write(data)
+    # populate filesystem cache
+    speedcopy.copyfile(str(tmpdir.join("warmup")),
+                       str(tmpdir.join("warmup.dst")))
+
+    calls = collections.Counter()
+
+    def counting(name, func):
+        def wrapper(*args, **kwargs):
+            calls[name] += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    for name in ("open", "fstat", "stat", "lstat", "read", "write",
+                 "close", "ftruncate"):
+        monkeypatch.setattr(os, name, counting(name, getattr(os, name)))
+    monkeypatch.setattr(speedcopy, "_sendfile",
+                        counting("sendfile", speedcopy._sendfile))
+    # statfs through ctypes, filesystem info must come from cache
+    monkeypatch.setattr(speedcopy, "_filesystem_info",
+                        counting("filesystem_info",
+                                 speedcopy._filesystem_info))
+    monkeypatch.setattr(FilesystemInfo, "filesystem",
+                        counting("statfs", FilesystemInfo.filesystem))
+
+    src = str(tmpdir.join("source"))
+    dst = str(tmpdir.join("destination"))
+    speedcopy.copyfile(src, dst)
+
+    assert dict(calls) == {
+        "open": 2, "fstat": 2, "read": 1, "write": 1, "close": 2}
+    monkeypatch.undo()
+    assert os.stat(src).st_dev in speedcopy._fs_type_cache
+    with open(dst, "rb") as f:
+        assert f.read() == data
+
+
+@pytest.mark.skipif(sys.platform.startswith("win32"),
+                    reason="small-file fast path is not used on Windows")
+def test_small_file_overwrite(tmpdir):
+    """Test small file overwriting larger destination is truncated."""
+    src = tmpdir.join("source")
+    dst = tmpdir.join("destination")
+    with open(str(src), "wb") as f:
+        f.write(b"small")
+    with open(str(dst), "wb") as f:
+        f.write(os.urandom(8 * 1024))
+
+    speedcopy.copyfile(str(src), str(dst))
+
+    with open(str(dst), "rb") as f:
+        assert f.read() == b"small"
+    with pytest.raises(shutil.SameFileError):
+        speedcopy.copyfile(str(src), str(src))
+
+
+# own import time of speedcopy modules (without stdlib) in microseconds
+_IMPORT_TIME_LIMIT_US = 50000
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason="-X importtime is available since Python 3.7")
+def test_import_time():
+    """Test import is fast and backends are not initialized on import."""
+    code = ("import sys, speedcopy; "
+            "print(' '.join(sorted(sys.modules)))")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+
+    modules = set(proc.stdout.split())
+    for heavy in ("ctypes", "speedcopy.fstatfs", "multiprocessing",
+                  "hashlib", "sqlite3", "subprocess"):
+        assert heavy not in modules
+
+    self_time = 0
+    for line in proc.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip().startswith("speedcopy"):
+            self_time += int(fields[0].split(":")[1])
+    assert 0 < self_time < _IMPORT_TIME_LIMIT_US
+
+
+@pytest.mark.skipif(not os.path.isfile("/proc/self/status"),
+                    reason="procfs is not available")
+def test_small_file_zero_reported_size(tmpdir):
+    """Test file reporting zero size (procfs) is copied whole."""
+    src = "/proc/self/status"
+    dst = str(tmpdir.join("destination"))
+    assert os.stat(src).st_size == 0
+
+    speedcopy.copyfile(src, dst)
+
+    with open(dst, "rb") as f:
+        assert f.read().startswith(b"Name:")
+
+
+@pytest.mark.skipif(sys.platform.startswith("win32"),
+                    reason="small-file fast path is not used on Windows")
+def test_small_file_short_reads(tmpdir, monkeypatch):
+    """Test small-file fast path reads until whole file is read."""
+    data = os.urandom(10 * 1024)
+    src = str(tmpdir.join("source"))
+    dst = str(tmpdir.join("destination"))
+    with open(src, "wb") as f:
+        f.write(data)
+
+    real_read = os.read
+    monkeypatch.setattr(
+        os, "read", lambda fd, n: real_read(fd, min(n, 1000)))
+    speedcopy.copyfile(src, dst)
+    monkeypatch.undo()
+
+    with open(dst, "rb") as f:
+        assert f.read() == data
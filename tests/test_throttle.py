@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Tests for bandwidth and IOPS throttling."""
+
+import os
+import threading
+import time
+
+import pytest
+
+import speedcopy
+from speedcopy import throttle
+
+_MB = 1024 * 1024
+
+
+def teardown_function(function):
+    """Test teardown."""
+    throttle.clear_rate_limits()
+
+
+def _expected_time(amount, rate):
+    """Expected duration of transfer including initial burst."""
+    return (amount - max(rate * throttle.BURST_SECONDS, 1)) / float(rate)
+
+
+def _make_files(tmpdir, count, size):
+    """Create source files, return copy pairs."""
+    pairs = []
+    for i in range(count):
+        src = str(tmpdir.join("f{}".format(i)))
+        with open(src, "wb") as f:
+            f.write(os.urandom(size))
+        pairs.append((src, src + ".dst"))
+    return pairs
+
+
+@pytest.mark.parametrize("use_sendfile", [True, False])
+def test_bytes_per_sec(tmpdir, monkeypatch, use_sendfile):
+    """Test achieved bandwidth matches the global limit."""
+    if not use_sendfile:
+        # force buffered copy
+        monkeypatch.setattr(speedcopy, "_sendfile", None, raising=False)
+    rate = 8 * _MB
+    pairs = _make_files(tmpdir, 3, 1 * _MB)
+    throttle.set_rate_limit(bytes_per_sec=rate)
+
+    start = time.time()
+    for src, dst in pairs:
+        speedcopy.copyfile(src, dst)
+    elapsed = time.time() - start
+
+    assert elapsed == pytest.approx(_expected_time(3 * _MB, rate), rel=0.25)
+
+
+def test_files_per_sec_per_mount(tmpdir):
+    """Test achieved files/s matches limit of destination mount."""
+    rate = 40
+    pairs = _make_files(tmpdir, 20, 1024)
+    throttle.set_rate_limit(files_per_sec=rate, mount=str(tmpdir))
+
+    start = time.time()
+    speedcopy.copyfiles(pairs)
+    elapsed = time.time() - start
+
+    assert elapsed == pytest.approx(_expected_time(20, rate), rel=0.25)
+
+
+def _copy_in_thread(src, dst):
+    """Start copy in background thread."""
+    thread = threading.Thread(target=speedcopy.copyfile, args=(src, dst))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+@pytest.mark.parametrize("clear", [False, True])
+def test_adjust_at_runtime(tmpdir, clear):
+    """Test changed or removed limit applies to copy already waiting."""
+    src, dst = _make_files(tmpdir, 1, 300 * 1000)[0]
+    throttle.set_rate_limit(bytes_per_sec=10 * 1024)
+
+    start = time.time()
+    thread = _copy_in_thread(src, dst)
+    time.sleep(0.5)
+    assert thread.is_alive()
+    if clear:
+        throttle.clear_rate_limits()
+        assert not throttle.active()
+        assert not throttle.limiter(os.stat(str(tmpdir)).st_dev).throttled()
+    else:
+        throttle.set_rate_limit(bytes_per_sec=1024 * _MB)
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert time.time() - start < 2
+    with open(src, "rb") as f1, open(dst, "rb") as f2:
+        assert f1.read() == f2.read()
+
+
+def test_limit_added_during_copy(tmpdir, monkeypatch):
+    """Test limit set while unthrottled copy is running applies to it."""
+    if not speedcopy._sendfile:
+        pytest.skip("sendfile is not available")
+    monkeypatch.setattr(speedcopy, "_SENDFILE_CHUNK_SIZE", _MB)
+    started = threading.Event()
+    limit_set = threading.Event()
+    sendfile = speedcopy._sendfile
+
+    def wait_for_limit(*args):
+        if not started.is_set():
+            started.set()
+            limit_set.wait(5)
+        return sendfile(*args)
+
+    monkeypatch.setattr(speedcopy, "_sendfile", wait_for_limit)
+    src, dst = _make_files(tmpdir, 1, 4 * _MB)[0]
+    rate = 4 * _MB
+
+    thread = _copy_in_thread(src, dst)
+    assert started.wait(5)
+    start = time.time()
+    throttle.set_rate_limit(bytes_per_sec=rate, mount=str(tmpdir))
+    limit_set.set()
+    thread.join(5)
+    elapsed = time.time() - start
+
+    assert not thread.is_alive()
+    # the first chunk was sent before the limit was set
+    assert elapsed == pytest.approx(_expected_time(3 * _MB, rate), rel=0.25)
+    with open(src, "rb") as f1, open(dst, "rb") as f2:
+        assert f1.read() == f2.read()
+
+
+def test_set_one_limit_keeps_other(tmpdir):
+    """Test limits not passed to set_rate_limit are kept."""
+    dev = os.stat(str(tmpdir)).st_dev
+    throttle.set_rate_limit(files_per_sec=100, mount=str(tmpdir))
+    throttle.set_rate_limit(bytes_per_sec=_MB, mount=str(tmpdir))
+    limit = throttle.limiter(dev)
+    assert [b.rate for b in limit.byte_buckets] == [_MB]
+    assert [b.rate for b in limit.file_buckets] == [100]
+
+    throttle.set_rate_limit(files_per_sec=None, mount=str(tmpdir))
+    limit = throttle.limiter(dev)
+    assert [b.rate for b in limit.byte_buckets] == [_MB]
+    assert limit.file_buckets == []
+
+
+def test_invalid_rate():
+    """Test negative and zero rates are rejected."""
+    for rate in (-1, 0):
+        with pytest.raises(ValueError):
+            throttle.set_rate_limit(bytes_per_sec=rate)
+        with pytest.raises(ValueError):
+            throttle.TokenBucket(rate)
+    assert not throttle.active()